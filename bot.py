@@ -1,65 +1,241 @@
+import math
+import time
+import asyncio
+import queue
+import hashlib
 import logging
-import telebot
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from collections import OrderedDict
+from dataclasses import dataclass
 from telebot import types
-import openai
+from telebot.async_telebot import AsyncTeleBot
 from typing import Optional
 
 from config import config
 from database import db_manager, DatabaseError
+from throttling import ConcurrencyController, CircuitBreaker, UserRateLimiter, RateLimitState
 
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('bot.log'),
-        logging.StreamHandler()
-    ]
-)
+log_queue: queue.SimpleQueue = queue.SimpleQueue()
+log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+log_handlers = [
+    RotatingFileHandler('bot.log', maxBytes=10 * 1024 * 1024, backupCount=5, delay=True),
+    logging.StreamHandler()
+]
+for log_handler in log_handlers:
+    log_handler.setFormatter(log_formatter)
+
+root_logger = logging.getLogger()
+root_logger.setLevel(logging.INFO)
+root_logger.handlers = [QueueHandler(log_queue)]
+log_listener = QueueListener(log_queue, *log_handlers, respect_handler_level=True)
+log_listener.start()
 
 logger = logging.getLogger(__name__)
 
-bot = telebot.TeleBot(config.bot_token)
-openai.api_key = config.openai_api_key
+OPENAI_MODEL = "gpt-3.5-turbo"
+
+SYSTEM_PROMPT = "Ты полезный AI-ассистент. Отвечай понятно и подробно."
+
+TYPING_REFRESH_INTERVAL = 4
+SHUTDOWN_DRAIN_TIMEOUT = 5
+
+WELCOME_TEMPLATE = """🤖 Добро пожаловать, {first_name}!
+
+Я - AI-ассистент на базе OpenAI. Вы можете задавать мне любые вопросы!
+
+💫 Ваш баланс: {balance} запросов
+
+Доступные команды:
+/balance - Проверить баланс
+/buy - Купить запросы  
+/promo - Активировать промокод
+/help - Помощь
+
+Для начала просто напишите ваш вопрос!"""
+
+RESPONSE_TEMPLATE = "{response}\n\n💫 Осталось запросов: {balance}"
+
+BALANCE_WARNING_TEMPLATE = """❌ Недостаточно запросов. Баланс: {balance}
+
+💡 Пополните баланс: /buy
+🎁 Или используйте промокод: /promo"""
+
+PLANNED_COMMANDS = frozenset({'balance', 'buy', 'promo', 'help'})
+
+COMMAND_UNAVAILABLE_TEXT = "🚧 Эта команда пока недоступна. Просто задайте вопрос текстом."
+
+UNKNOWN_COMMAND_TEXT = "❓ Неизвестная команда. Начните с /start или просто задайте вопрос."
+
+bot = AsyncTeleBot(config.bot_token)
+concurrency_controller = ConcurrencyController(config.throttling)
+circuit_breaker = CircuitBreaker(config.throttling)
+user_rate_limiter = UserRateLimiter(config.throttling)
+rate_limit_state = RateLimitState.from_config(config.throttling)
 
 
 class OpenAIError(Exception):
     pass
 
 
+class _RetryAfter(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class Completion:
+    text: str
+    total_tokens: int
+    cached: bool = False
+
+
 class OpenAIService:
     
+    def __init__(self):
+        # Imported here so the bot can start polling without loading the SDK.
+        import httpx
+        import openai
+        
+        self._openai = openai
+        self._client = openai.AsyncOpenAI(
+            api_key=config.openai_api_key,
+            timeout=config.bot.request_timeout,
+            max_retries=0,
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=config.throttling.max_connections,
+                    max_keepalive_connections=config.throttling.max_keepalive_connections
+                )
+            )
+        )
+        self._cache: OrderedDict[bytes, tuple[float, str]] = OrderedDict()
+        self._encoding = None
+    
+    async def close(self) -> None:
+        await self._client.close()
+    
+    async def load_encoding(self) -> None:
+        """Load the tokenizer in a thread; tiktoken may download it on first use."""
+        self._encoding = await asyncio.to_thread(self._load_encoding)
+    
     @staticmethod
-    def generate_response(prompt: str, max_tokens: int = 1000) -> str:
+    def _load_encoding():
         try:
-            response = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",
+            import tiktoken
+            return tiktoken.encoding_for_model(OPENAI_MODEL)
+        except ImportError:
+            logger.warning("tiktoken not installed, estimating prompt tokens from length")
+        except Exception as e:
+            logger.warning(f"Failed to load tiktoken encoding: {e}")
+        return None
+    
+    def count_tokens(self, prompt: str) -> int:
+        if self._encoding is None:
+            return len(prompt) // 4
+        return len(self._encoding.encode(prompt))
+    
+    def plan_tokens(self, prompt: str) -> tuple[int, int]:
+        """Return (prompt_tokens, max_tokens) with the completion budget scaled to the prompt."""
+        prompt_tokens = self.count_tokens(prompt)
+        max_tokens = min(
+            config.bot.max_response_tokens,
+            max(config.bot.min_response_tokens, prompt_tokens * 3)
+        )
+        return prompt_tokens, max_tokens
+    
+    @staticmethod
+    def _cache_key(prompt: str) -> bytes:
+        return hashlib.blake2b(prompt.encode(), digest_size=16).digest()
+    
+    def _get_cached(self, key: bytes) -> Optional[str]:
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        
+        expires_at, text = entry
+        if expires_at < time.monotonic():
+            del self._cache[key]
+            return None
+        
+        self._cache.move_to_end(key)
+        return text
+    
+    def _store_cached(self, key: bytes, text: str) -> None:
+        self._cache[key] = (time.monotonic() + config.bot.response_cache_ttl, text)
+        self._cache.move_to_end(key)
+        if len(self._cache) > config.bot.response_cache_size:
+            self._cache.popitem(last=False)
+    
+    async def generate_response(self, prompt: str, max_tokens: int) -> Completion:
+        cache_key = self._cache_key(prompt)
+        cached_text = self._get_cached(cache_key)
+        if cached_text is not None:
+            return Completion(text=cached_text, total_tokens=0, cached=True)
+        
+        if not circuit_breaker.allow_request():
+            raise OpenAIError("Service temporarily unavailable due to high load")
+        
+        for attempt in range(2):
+            if rate_limit_state.delay > config.throttling.max_retry_after:
+                raise OpenAIError("Service temporarily unavailable due to high load")
+            await rate_limit_state.wait()
+            
+            async with concurrency_controller.acquire():
+                started_at = time.monotonic()
+                try:
+                    response = await self._request_completion(prompt, max_tokens)
+                except _RetryAfter:
+                    if attempt:
+                        raise OpenAIError("Service temporarily unavailable due to high load")
+                    continue
+                concurrency_controller.record_latency(time.monotonic() - started_at)
+            break
+        
+        if not response.choices:
+            raise OpenAIError("Empty response from OpenAI")
+        
+        text = response.choices[0].message.content.strip()
+        self._store_cached(cache_key, text)
+        
+        return Completion(
+            text=text,
+            total_tokens=response.usage.total_tokens if response.usage else 0
+        )
+    
+    async def _request_completion(self, prompt: str, max_tokens: int):
+        try:
+            raw_response = await self._client.chat.completions.with_raw_response.create(
+                model=OPENAI_MODEL,
                 messages=[
-                    {
-                        "role": "system", 
-                        "content": "Ты полезный AI-ассистент. Отвечай понятно и подробно."
-                    },
+                    {"role": "system", "content": SYSTEM_PROMPT},
                     {"role": "user", "content": prompt}
                 ],
                 max_tokens=max_tokens,
-                temperature=0.7,
-                timeout=config.bot.request_timeout
+                temperature=0.7
             )
+            rate_limit_state.update(raw_response.headers)
+            circuit_breaker.record_success()
+            return raw_response.parse()
             
-            if not response.choices:
-                raise OpenAIError("Empty response from OpenAI")
-            
-            return response.choices[0].message.content.strip()
-            
-        except openai.error.AuthenticationError as e:
+        except self._openai.AuthenticationError as e:
             logger.error(f"OpenAI authentication failed: {e}")
             raise OpenAIError("Invalid API key configuration")
             
-        except openai.error.RateLimitError as e:
+        except self._openai.RateLimitError as e:
+            concurrency_controller.decrease()
             logger.error(f"OpenAI rate limit exceeded: {e}")
+            retry_after = rate_limit_state.apply_retry_after(e.response.headers)
+            if retry_after is not None and retry_after <= config.throttling.max_retry_after:
+                raise _RetryAfter() from e
             raise OpenAIError("Service temporarily unavailable due to high load")
             
-        except openai.error.OpenAIError as e:
+        except (self._openai.InternalServerError, self._openai.APIConnectionError) as e:
+            concurrency_controller.decrease()
+            circuit_breaker.record_failure()
+            logger.error(f"OpenAI server error: {e}")
+            raise OpenAIError("AI service is currently unavailable")
+            
+        except self._openai.OpenAIError as e:
             logger.error(f"OpenAI API error: {e}")
             raise OpenAIError("AI service is currently unavailable")
             
@@ -70,13 +246,47 @@ class OpenAIService:
 
 class MessageHandler:
     
-    def __init__(self, bot_instance: telebot.TeleBot):
+    def __init__(self, bot_instance: AsyncTeleBot):
         self.bot = bot_instance
-        self.openai_service = OpenAIService()
+        self._openai_service_task: Optional[asyncio.Task] = None
+        self._encoding_task: Optional[asyncio.Task] = None
+        self._pending_sends: set[asyncio.Task] = set()
+    
+    def preload_openai_service(self) -> None:
+        """Start importing the OpenAI SDK in a thread so the event loop is never blocked."""
+        if self._openai_service_task is None:
+            self._openai_service_task = asyncio.create_task(self._load_openai_service())
+    
+    async def _load_openai_service(self) -> OpenAIService:
+        service = await asyncio.to_thread(OpenAIService)
+        self._encoding_task = asyncio.create_task(service.load_encoding())
+        return service
+    
+    async def get_openai_service(self) -> OpenAIService:
+        self.preload_openai_service()
+        task = self._openai_service_task
+        try:
+            return await task
+        except Exception as e:
+            if self._openai_service_task is task:
+                self._openai_service_task = None
+            logger.error(f"Failed to initialise OpenAI client: {e}")
+            raise OpenAIError("AI service is currently unavailable") from e
+    
+    async def shutdown(self) -> None:
+        """Give queued replies a chance to reach Telegram, then release the OpenAI pool."""
+        if self._pending_sends:
+            _, still_pending = await asyncio.wait(self._pending_sends, timeout=SHUTDOWN_DRAIN_TIMEOUT)
+            if still_pending:
+                logger.warning(f"Dropping {len(still_pending)} undelivered replies on shutdown")
+        
+        task = self._openai_service_task
+        if task is not None and task.done() and not task.cancelled() and task.exception() is None:
+            await task.result().close()
     
-    def handle_start_command(self, message: types.Message) -> None:
+    async def handle_start_command(self, message: types.Message) -> None:
         try:
-            user = db_manager.get_or_create_user(
+            user = await db_manager.get_or_create_user(
                 tg_id=message.from_user.id,
                 username=message.from_user.username,
                 first_name=message.from_user.first_name,
@@ -84,120 +294,225 @@ class MessageHandler:
             )
             
             welcome_text = self._build_welcome_message(
-                user['balance'],
+                user.balance,
                 message.from_user.first_name
             )
             
-            self.bot.send_message(message.chat.id, welcome_text)
+            await self.bot.send_message(message.chat.id, welcome_text)
             logger.info(f"New user started: {message.from_user.id}")
             
         except DatabaseError as e:
             logger.error(f"Database error in start command: {e}")
-            self.bot.send_message(
+            await self.bot.send_message(
                 message.chat.id,
                 "❌ Произошла ошибка при регистрации. Попробуйте позже."
             )
     
-    def handle_text_message(self, message: types.Message) -> None:
+    async def handle_text_message(self, message: types.Message) -> None:
         user_id = message.from_user.id
         user_text = message.text.strip()
         
         if not user_text:
-            self.bot.send_message(message.chat.id, "❌ Сообщение не может быть пустым.")
+            await self.bot.send_message(message.chat.id, "❌ Сообщение не может быть пустым.")
+            return
+        
+        if user_text.startswith('/'):
+            command = user_text[1:].partition(' ')[0].partition('@')[0].lower()
+            if command in PLANNED_COMMANDS:
+                await self.bot.send_message(message.chat.id, COMMAND_UNAVAILABLE_TEXT)
+            else:
+                await self.bot.send_message(message.chat.id, UNKNOWN_COMMAND_TEXT)
             return
         
         try:
-            user = db_manager.get_or_create_user(user_id)
-            if user['balance'] <= 0:
-                self._send_balance_warning(message.chat.id, user['balance'])
+            user = await db_manager.get_or_create_user(user_id)
+            if user.balance <= 0:
+                await self._send_balance_warning(message.chat.id, user.balance)
                 return
             
-            processing_msg = self.bot.send_message(
-                message.chat.id, 
-                "⏳ Обрабатываю запрос..."
-            )
+            openai_service = await self.get_openai_service()
+            prompt_tokens, max_tokens = openai_service.plan_tokens(user_text)
+            token_estimate = prompt_tokens + max_tokens
+            bucket = await user_rate_limiter.get_bucket(user_id)
+            if not bucket.try_acquire(token_estimate):
+                wait_seconds = math.ceil(bucket.wait_time(token_estimate))
+                await self.bot.send_message(
+                    message.chat.id,
+                    f"⏳ Слишком много запросов, подождите {wait_seconds}s"
+                )
+                return
             
-            response = self.openai_service.generate_response(user_text)
+            typing_task = asyncio.create_task(self._keep_typing(message.chat.id))
+            try:
+                completion = await openai_service.generate_response(user_text, max_tokens)
+            except OpenAIError:
+                bucket.force_add_usage(-token_estimate)
+                raise
+            finally:
+                typing_task.cancel()
             
-            if db_manager.ensure_sufficient_balance(user_id):
-                final_text = self._build_response_text(response, user['balance'] - 1)
-                self.bot.edit_message_text(
-                    final_text,
-                    chat_id=message.chat.id,
-                    message_id=processing_msg.message_id
-                )
-                logger.info(f"Successfully processed request for user {user_id}")
+            bucket.force_add_usage(completion.total_tokens - token_estimate)
+            
+            if completion.cached:
+                remaining_balance = user.balance
+                logger.info(f"Served cached response for user {user_id}")
             else:
-                raise DatabaseError("Failed to deduct balance")
+                charged_user = await db_manager.debit_balance(user_id)
+                if charged_user is None:
+                    raise DatabaseError("Failed to deduct balance")
+                remaining_balance = charged_user.balance
+            
+            await self._send_in_background(
+                message.chat.id,
+                self._build_response_text(completion.text, remaining_balance)
+            )
+            logger.info(f"Successfully processed request for user {user_id}")
                 
         except OpenAIError as e:
-            self.bot.edit_message_text(
-                f"❌ {str(e)}",
-                chat_id=message.chat.id,
-                message_id=processing_msg.message_id
-            )
+            await self.bot.send_message(message.chat.id, f"❌ {str(e)}")
             logger.warning(f"OpenAI error for user {user_id}: {e}")
             
         except DatabaseError as e:
-            self.bot.edit_message_text(
-                "❌ Ошибка обработки запроса. Попробуйте позже.",
-                chat_id=message.chat.id,
-                message_id=processing_msg.message_id
+            await self.bot.send_message(
+                message.chat.id,
+                "❌ Ошибка обработки запроса. Попробуйте позже."
             )
             logger.error(f"Database error for user {user_id}: {e}")
     
+    async def _send_in_background(self, chat_id: int, text: str) -> None:
+        """Send without waiting for Telegram; falls back to inline when too many are pending."""
+        if len(self._pending_sends) >= config.bot.max_pending_sends:
+            await self.bot.send_message(chat_id, text)
+            return
+        
+        task = asyncio.create_task(self.bot.send_message(chat_id, text))
+        self._pending_sends.add(task)
+        task.add_done_callback(self._on_send_done)
+    
+    def _on_send_done(self, task: asyncio.Task) -> None:
+        self._pending_sends.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Failed to deliver reply: {task.exception()}")
+    
+    async def _keep_typing(self, chat_id: int) -> None:
+        """Keep the typing indicator visible until cancelled."""
+        try:
+            while True:
+                await self.bot.send_chat_action(chat_id, 'typing')
+                await asyncio.sleep(TYPING_REFRESH_INTERVAL)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Failed to send typing action to {chat_id}: {e}")
+    
     def _build_welcome_message(self, balance: int, first_name: str) -> str:
-        return f"""🤖 Добро пожаловать, {first_name}!
-
-Я - AI-ассистент на базе OpenAI. Вы можете задавать мне любые вопросы!
-
-💫 Ваш баланс: {balance} запросов
-
-Доступные команды:
-/balance - Проверить баланс
-/buy - Купить запросы  
-/promo - Активировать промокод
-/help - Помощь
-
-Для начала просто напишите ваш вопрос!"""
+        return WELCOME_TEMPLATE.format_map({'first_name': first_name, 'balance': balance})
     
     def _build_response_text(self, response: str, remaining_balance: int) -> str:
         """Build final response text with balance info."""
-        return f"{response}\n\n💫 Осталось запросов: {remaining_balance}"
+        return RESPONSE_TEMPLATE.format_map({'response': response, 'balance': remaining_balance})
     
-    def _send_balance_warning(self, chat_id: int, balance: int) -> None:
+    async def _send_balance_warning(self, chat_id: int, balance: int) -> None:
         """Send balance warning message."""
-        warning_text = f"""❌ Недостаточно запросов. Баланс: {balance}
-
-💡 Пополните баланс: /buy
-🎁 Или используйте промокод: /promo"""
-        
-        self.bot.send_message(chat_id, warning_text)
+        await self.bot.send_message(chat_id, BALANCE_WARNING_TEMPLATE.format_map({'balance': balance}))
 
 
 message_handler = MessageHandler(bot)
 
 
 @bot.message_handler(commands=['start'])
-def handle_start(message: types.Message):
-    message_handler.handle_start_command(message)
+async def handle_start(message: types.Message):
+    await message_handler.handle_start_command(message)
 
 
 @bot.message_handler(content_types=['text'])
-def handle_text(message: types.Message):
-    message_handler.handle_text_message(message)
+async def handle_text(message: types.Message):
+    await message_handler.handle_text_message(message)
+
+
+ALLOWED_UPDATES = ['message']
+
+_webhook_tasks: set[asyncio.Task] = set()
+
+
+async def run_polling() -> None:
+    await bot.remove_webhook()
+    await bot.infinity_polling(
+        timeout=50,
+        request_timeout=60,
+        allowed_updates=ALLOWED_UPDATES
+    )
+
+
+async def run_webhook() -> None:
+    from aiohttp import web
+    
+    webhook = config.webhook
+    
+    async def handle_update(request: web.Request) -> web.Response:
+        if request.headers.get('X-Telegram-Bot-Api-Secret-Token') != webhook.secret_token:
+            return web.Response(status=403)
+        
+        try:
+            update = types.Update.de_json(await request.json())
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Rejected malformed webhook payload: {e}")
+            return web.Response(status=400)
+        
+        task = asyncio.create_task(bot.process_new_updates([update]))
+        _webhook_tasks.add(task)
+        task.add_done_callback(_webhook_tasks.discard)
+        return web.Response()
+    
+    app = web.Application()
+    app.router.add_post(f'/{webhook.secret_token}', handle_update)
+    
+    runner = web.AppRunner(app)
+    await runner.setup()
+    
+    try:
+        await web.TCPSite(runner, webhook.host, webhook.port).start()
+        await bot.remove_webhook()
+        await bot.set_webhook(
+            url=f"{webhook.url.rstrip('/')}/{webhook.secret_token}",
+            secret_token=webhook.secret_token,
+            allowed_updates=ALLOWED_UPDATES,
+            max_connections=webhook.max_connections
+        )
+        logger.info(f"Webhook server listening on {webhook.host}:{webhook.port}")
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+async def run_bot() -> None:
+    await db_manager.init()
+    message_handler.preload_openai_service()
+    
+    try:
+        if config.webhook.enabled:
+            await run_webhook()
+        else:
+            await run_polling()
+    finally:
+        if _webhook_tasks:
+            await asyncio.wait(_webhook_tasks, timeout=SHUTDOWN_DRAIN_TIMEOUT)
+        await message_handler.shutdown()
+        await bot.close_session()
+        await db_manager.close()
 
 
 def main():
     logger.info("Starting Telegram bot...")
     
     try:
-        bot.infinity_polling(timeout=60, long_polling_timeout=30)
+        asyncio.run(run_bot())
     except Exception as e:
         logger.critical(f"Bot crashed: {e}")
         raise
     finally:
         logger.info("Bot stopped")
+        log_listener.stop()
 
 
 if __name__ == "__main__":
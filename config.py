@@ -1,5 +1,6 @@
 import os
 import logging
+import secrets
 from typing import Optional
 from dataclasses import dataclass
 
@@ -8,13 +9,21 @@ from dataclasses import dataclass
 class DatabaseConfig:
     name: str = "bot_database.db"
     timeout: int = 30
+    pool_size: int = 4
+    cached_statements: int = 256
+    write_batch_window: float = 0.005
+    write_batch_size: int = 64
     pragmas: dict = None
     
     def __post_init__(self):
         if self.pragmas is None:
             object.__setattr__(self, 'pragmas', {
                 'journal_mode': 'wal',
+                'synchronous': 'NORMAL',
+                'busy_timeout': 5000,
                 'cache_size': -64000,
+                'temp_store': 'MEMORY',
+                'mmap_size': 268435456,
                 'foreign_keys': 1,
                 'ignore_check_constraints': 0
             })
@@ -25,6 +34,45 @@ class BotConfig:
     default_free_requests: int = 3
     max_requests_per_user: int = 1000
     request_timeout: int = 30
+    max_response_tokens: int = 1000
+    min_response_tokens: int = 128
+    response_cache_ttl: int = 300
+    response_cache_size: int = 1024
+    max_pending_sends: int = 256
+
+
+@dataclass(frozen=True)
+class ThrottlingConfig:
+    min_concurrency: int = 1
+    max_concurrency: int = 32
+    initial_concurrency: int = 8
+    increase_step: float = 0.5
+    decrease_factor: float = 0.5
+    decrease_interval: float = 8.0
+    latency_target: float = 8.0
+    latency_window: int = 20
+    breaker_threshold: int = 5
+    breaker_cooldown: float = 30.0
+    user_tokens_per_minute: int = 6000
+    max_tracked_users: int = 10000
+    min_remaining_requests: int = 2
+    min_remaining_tokens_ratio: float = 0.1
+    max_retry_after: float = 10.0
+    max_connections: int = 64
+    max_keepalive_connections: int = 32
+
+
+@dataclass(frozen=True)
+class WebhookConfig:
+    url: Optional[str] = None
+    secret_token: str = ''
+    host: str = '0.0.0.0'
+    port: int = 8080
+    max_connections: int = 40
+    
+    @property
+    def enabled(self) -> bool:
+        return bool(self.url)
 
 
 class Config:
@@ -35,6 +83,8 @@ class Config:
         
         self.database = DatabaseConfig()
         self.bot = BotConfig()
+        self.throttling = ThrottlingConfig()
+        self.webhook = self._load_webhook_config()
     
     def _load_environment_variables(self) -> None:
         try:
@@ -52,6 +102,20 @@ class Config:
             logging.error(f"Invalid ADMIN_ID format: {e}")
             self.admin_id = 0
     
+    def _load_webhook_config(self) -> WebhookConfig:
+        try:
+            port = int(os.getenv('WEBHOOK_PORT', '8080'))
+        except (TypeError, ValueError) as e:
+            logging.error(f"Invalid WEBHOOK_PORT format: {e}")
+            port = 8080
+        
+        return WebhookConfig(
+            url=os.getenv('WEBHOOK_URL'),
+            secret_token=os.getenv('WEBHOOK_SECRET') or secrets.token_urlsafe(32),
+            host=os.getenv('WEBHOOK_HOST', '0.0.0.0'),
+            port=port
+        )
+    
     def _validate_required_settings(self) -> None:
         missing_vars = []
         
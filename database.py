@@ -1,156 +1,404 @@
+import asyncio
 import sqlite3
 import logging
-import threading
-from typing import Optional, List, Dict, Any
-from contextlib import contextmanager
-from config import config
+from dataclasses import dataclass, field
+from typing import Optional, List, Any, Tuple
+from contextlib import asynccontextmanager
+
+import aiosqlite
+
+from config import config, DatabaseConfig
+
+
+_SQL_GET_USER = "SELECT * FROM users WHERE tg_id = ?"
+
+_SQL_INSERT_USER = '''
+    INSERT OR IGNORE INTO users
+    (tg_id, username, first_name, last_name, balance)
+    VALUES (?, ?, ?, ?, ?)
+'''
+
+_SQL_DEBIT = '''
+    UPDATE users
+    SET balance = balance - ?,
+        total_requests = total_requests + ?,
+        updated_at = CURRENT_TIMESTAMP
+    WHERE tg_id = ? AND balance >= ?
+    RETURNING *
+'''
+
+_HOT_READS = (_SQL_GET_USER,)
+
+_HOT_WRITES = (_SQL_INSERT_USER, _SQL_DEBIT)
+
+_SCHEMA = (
+    '''
+    CREATE TABLE IF NOT EXISTS users (
+        tg_id INTEGER PRIMARY KEY,
+        username TEXT,
+        first_name TEXT,
+        last_name TEXT,
+        balance INTEGER DEFAULT 3,
+        total_requests INTEGER DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS payments (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        tg_id INTEGER NOT NULL,
+        amount INTEGER NOT NULL,
+        stars_paid INTEGER NOT NULL,
+        payment_id TEXT UNIQUE,
+        status TEXT DEFAULT 'completed',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (tg_id) REFERENCES users (tg_id)
+    )
+    ''',
+    '''
+    CREATE INDEX IF NOT EXISTS ix_payments_tgid_created
+    ON payments (tg_id, created_at DESC)
+    ''',
+    '''
+    CREATE INDEX IF NOT EXISTS ix_payments_status
+    ON payments (status) WHERE status != 'completed'
+    ''',
+)
 
 
 class DatabaseError(Exception):
+    pass
+
+
+class DatabaseLockedError(DatabaseError):
+    pass
 
 
-class DatabaseConnection:
+@dataclass(slots=True)
+class User:
+    tg_id: int
+    username: Optional[str]
+    first_name: Optional[str]
+    last_name: Optional[str]
+    balance: int
+    total_requests: int
+    created_at: str
+    updated_at: str
+
+
+@dataclass
+class WriteResult:
+    rowcount: int
+    rows: List[tuple]
+
+
+@dataclass
+class _WriteRequest:
+    sql: str
+    params: Tuple[Any, ...]
+    future: asyncio.Future = field(repr=False)
+
+
+class AsyncDatabase:
+    """aiosqlite backend with one writer task and a pool of reader connections.
+    
+    All writes are funnelled through a queue into a single connection, so
+    writers never contend on the SQLite write lock inside this process;
+    reads run concurrently on the reader pool under WAL.
+    """
     
     def __init__(self, db_config: DatabaseConfig):
         self.db_config = db_config
-        self._local = threading.local()
+        self._readers: asyncio.Queue = asyncio.Queue()
+        self._write_q: asyncio.Queue = asyncio.Queue()
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._writer_task: Optional[asyncio.Task] = None
+    
+    async def connect(self) -> None:
+        self._writer = await self._open_connection()
+        for _ in range(self.db_config.pool_size):
+            self._readers.put_nowait(await self._open_connection())
+        
+        self._writer_task = asyncio.create_task(self._writer_loop())
+    
+    async def _open_connection(self) -> aiosqlite.Connection:
+        try:
+            conn = await aiosqlite.connect(
+                self.db_config.name,
+                timeout=self.db_config.timeout,
+                isolation_level=None,
+                cached_statements=self.db_config.cached_statements
+            )
+            
+            for pragma, value in self.db_config.pragmas.items():
+                await conn.execute(f"PRAGMA {pragma} = {value}")
+            
+            return conn
+        
+        except sqlite3.Error as e:
+            logging.error(f"Database connection failed: {e}")
+            raise DatabaseError(f"Connection failed: {e}")
     
-    def _get_connection(self) -> sqlite3.Connection:
-        if not hasattr(self._local, 'connection'):
+    @asynccontextmanager
+    async def reader(self):
+        conn = await self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+    
+    async def fetch_one(self, sql: str, params: Tuple[Any, ...] = ()) -> Optional[tuple]:
+        async with self.reader() as conn:
             try:
-                conn = sqlite3.connect(
-                    self.db_config.name,
-                    timeout=self.db_config.timeout,
-                    check_same_thread=False
-                )
-                
-                for pragma, value in self.db_config.pragmas.items():
-                    conn.execute(f"PRAGMA {pragma} = {value}")
-                
-                conn.row_factory = sqlite3.Row
-                self._local.connection = conn
-                
+                async with conn.execute(sql, params) as cursor:
+                    return await cursor.fetchone()
             except sqlite3.Error as e:
-                logging.error(f"Database connection failed: {e}")
-                raise DatabaseError(f"Connection failed: {e}")
+                logging.error(f"Database read failed: {e}")
+                raise DatabaseError(f"Operation failed: {e}") from e
+    
+    async def write(self, sql: str, params: Tuple[Any, ...] = ()) -> WriteResult:
+        future = asyncio.get_running_loop().create_future()
+        await self._write_q.put(_WriteRequest(sql, params, future))
+        return await future
+    
+    async def _writer_loop(self) -> None:
+        while True:
+            batch = await self._collect_batch()
+            try:
+                results = await self._execute_with_retry(batch)
+            except Exception as e:
+                results = [e] * len(batch)
+            
+            for request, result in zip(batch, results):
+                if request.future.done():
+                    continue
+                if isinstance(result, Exception):
+                    request.future.set_exception(result)
+                else:
+                    request.future.set_result(result)
+    
+    async def _collect_batch(self) -> List[_WriteRequest]:
+        """Group writes arriving within the batch window so they share one commit."""
+        loop = asyncio.get_running_loop()
+        batch = [await self._write_q.get()]
+        deadline = loop.time() + self.db_config.write_batch_window
+        
+        while len(batch) < self.db_config.write_batch_size:
+            try:
+                batch.append(self._write_q.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            
+            try:
+                batch.append(await asyncio.wait_for(self._write_q.get(), remaining))
+            except asyncio.TimeoutError:
+                break
         
-        return self._local.connection
+        return batch
+    
+    async def _execute_with_retry(self, batch: List[_WriteRequest], max_retries: int = 5,
+                                  initial_delay: float = 0.2) -> List[Any]:
+        """Run a batch, retrying with exponential backoff while the database is locked."""
+        for attempt in range(max_retries + 1):
+            try:
+                return await self._execute_batch(batch)
+            except DatabaseLockedError as e:
+                if attempt == max_retries:
+                    logging.error(f"Database still locked after {max_retries} retries: {e}")
+                    raise
+                
+                delay = initial_delay * 2 ** attempt
+                logging.warning(f"Database locked, retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
     
-    @contextmanager
-    def get_cursor(self):
-        conn = self._get_connection()
-        cursor = conn.cursor()
+    async def _execute_batch(self, batch: List[_WriteRequest]) -> List[Any]:
+        """Commit a batch in one transaction; each request gets a WriteResult or its own error.
         
+        Every request runs under a savepoint, so a failing statement is
+        rolled back on its own without discarding the rest of the batch.
+        """
+        conn = self._writer
         try:
-            yield cursor
-            conn.commit()
+            await conn.execute("BEGIN IMMEDIATE")
+            results = []
+            
+            for request in batch:
+                await conn.execute("SAVEPOINT write_request")
+                try:
+                    async with conn.execute(request.sql, request.params) as cursor:
+                        rows = await cursor.fetchall()
+                        rowcount = cursor.rowcount
+                except sqlite3.OperationalError as e:
+                    if self._is_lock_error(e):
+                        raise
+                    results.append(await self._rollback_request(conn, e))
+                except sqlite3.Error as e:
+                    results.append(await self._rollback_request(conn, e))
+                else:
+                    await conn.execute("RELEASE write_request")
+                    results.append(WriteResult(rowcount=rowcount, rows=rows))
+            
+            await conn.commit()
+            return results
+        
+        except sqlite3.OperationalError as e:
+            await self._rollback(conn)
+            if self._is_lock_error(e):
+                raise DatabaseLockedError(f"Database is locked: {e}") from e
+            logging.error(f"Database operation failed: {e}")
+            raise DatabaseError(f"Operation failed: {e}") from e
         except sqlite3.Error as e:
-            conn.rollback()
+            await self._rollback(conn)
             logging.error(f"Database operation failed: {e}")
-            raise DatabaseError(f"Operation failed: {e}")
+            raise DatabaseError(f"Operation failed: {e}") from e
+    
+    @staticmethod
+    async def _rollback_request(conn: aiosqlite.Connection, error: sqlite3.Error) -> DatabaseError:
+        await conn.execute("ROLLBACK TO write_request")
+        await conn.execute("RELEASE write_request")
+        logging.error(f"Database operation failed: {error}")
+        
+        result = DatabaseError(f"Operation failed: {error}")
+        result.__cause__ = error
+        return result
+    
+    @staticmethod
+    async def _rollback(conn: aiosqlite.Connection) -> None:
+        if conn.in_transaction:
+            await conn.rollback()
+    
+    @staticmethod
+    def _is_lock_error(error: sqlite3.OperationalError) -> bool:
+        message = str(error).lower()
+        return 'locked' in message or 'busy' in message
+    
+    async def execute_schema(self, statements) -> None:
+        for sql in statements:
+            await self.write(sql)
+    
+    async def warm_up(self, reads, writes) -> None:
+        """Prime the statement caches with the exact hot statement texts.
+        
+        Reads run against every reader with NULL parameters, which match no
+        rows; writes run on the writer inside a transaction that is rolled
+        back. Called during init, before the writer queue receives traffic.
+        """
+        readers = [self._readers.get_nowait() for _ in range(self._readers.qsize())]
+        
+        try:
+            for conn in readers:
+                for sql in reads:
+                    async with conn.execute(sql, (None,) * sql.count('?')) as cursor:
+                        await cursor.fetchall()
+            
+            await self._writer.execute("BEGIN")
+            try:
+                for sql in writes:
+                    async with self._writer.execute(sql, (None,) * sql.count('?')) as cursor:
+                        await cursor.fetchall()
+            finally:
+                await self._writer.rollback()
+        except sqlite3.Error as e:
+            logging.warning(f"Statement warm-up failed: {e}")
         finally:
-            cursor.close()
+            for conn in readers:
+                self._readers.put_nowait(conn)
     
-    def close(self):
-        if hasattr(self._local, 'connection'):
+    async def close(self) -> None:
+        if self._writer_task is not None:
+            self._writer_task.cancel()
+            try:
+                await self._writer_task
+            except asyncio.CancelledError:
+                pass
+            self._writer_task = None
+        
+        connections = [self._readers.get_nowait() for _ in range(self._readers.qsize())]
+        if self._writer is not None:
+            connections.append(self._writer)
+            self._writer = None
+        
+        for conn in connections:
             try:
-                self._local.connection.close()
-                delattr(self._local, 'connection')
+                await conn.close()
             except sqlite3.Error as e:
                 logging.error(f"Error closing connection: {e}")
 
 
 class UserRepository:
+    """Users table access.
     
-    def __init__(self, db_connection: DatabaseConnection):
-        self.db = db_connection
-        self._init_schema()
-    
-    def _init_schema(self) -> None:
-        with self.db.get_cursor() as cursor:
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    tg_id INTEGER PRIMARY KEY,
-                    username TEXT,
-                    first_name TEXT,
-                    last_name TEXT,
-                    balance INTEGER DEFAULT 3,
-                    total_requests INTEGER DEFAULT 0,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS payments (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    tg_id INTEGER NOT NULL,
-                    amount INTEGER NOT NULL,
-                    stars_paid INTEGER NOT NULL,
-                    payment_id TEXT UNIQUE,
-                    status TEXT DEFAULT 'completed',
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (tg_id) REFERENCES users (tg_id)
-                )
-            ''')
-    
-    def get_user(self, tg_id: int) -> Optional[Dict[str, Any]]:
-        with self.db.get_cursor() as cursor:
-            cursor.execute(
-                "SELECT * FROM users WHERE tg_id = ?",
-                (tg_id,)
-            )
-            result = cursor.fetchone()
-            return dict(result) if result else None
-    
-    def create_user(self, tg_id: int, username: str = None, 
-                   first_name: str = None, last_name: str = None) -> Dict[str, Any]:
-        with self.db.get_cursor() as cursor:
-            cursor.execute('''
-                INSERT OR IGNORE INTO users 
-                (tg_id, username, first_name, last_name, balance)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (tg_id, username, first_name, last_name, config.bot.default_free_requests))
-            
-            cursor.execute(
-                "SELECT * FROM users WHERE tg_id = ?",
-                (tg_id,)
-            )
-            result = cursor.fetchone()
-            
-            if not result:
-                raise DatabaseError("Failed to create user")
-            
-            return dict(result)
-    
-    def update_balance(self, tg_id: int, delta: int) -> bool:
-        with self.db.get_cursor() as cursor:
-            cursor.execute('''
-                UPDATE users 
-                SET balance = balance + ?, 
-                    updated_at = CURRENT_TIMESTAMP,
-                    total_requests = total_requests + ABS(?)
-                WHERE tg_id = ? AND balance + ? >= 0
-            ''', (delta, -delta if delta < 0 else 0, tg_id, delta))
-            
-            return cursor.rowcount > 0
+    Each write method issues a single statement to the writer task. The
+    writer group-commits the statements queued within a short window,
+    up to write_batch_size, in one BEGIN IMMEDIATE transaction. Each
+    statement runs under its own savepoint, so a failing one is rolled
+    back alone. No transaction is ever held open across network calls
+    such as OpenAI.
+    """
+    
+    def __init__(self, database: AsyncDatabase):
+        self.db = database
+    
+    async def init_schema(self) -> None:
+        await self.db.execute_schema(_SCHEMA)
+        await self.db.warm_up(_HOT_READS, _HOT_WRITES)
+    
+    async def get_user(self, tg_id: int) -> Optional[User]:
+        result = await self.db.fetch_one(_SQL_GET_USER, (tg_id,))
+        return User(*result) if result else None
+    
+    async def create_user(self, tg_id: int, username: str = None,
+                          first_name: str = None, last_name: str = None) -> User:
+        await self.db.write(
+            _SQL_INSERT_USER,
+            (tg_id, username, first_name, last_name, config.bot.default_free_requests)
+        )
+        
+        user = await self.get_user(tg_id)
+        if not user:
+            raise DatabaseError("Failed to create user")
+        
+        return user
+    
+    async def debit_and_fetch(self, tg_id: int, cost: int) -> Optional[User]:
+        """Atomically charge cost requests; None if the user is missing or short on balance."""
+        result = await self.db.write(_SQL_DEBIT, (cost, cost, tg_id, cost))
+        return User(*result.rows[0]) if result.rows else None
 
 
 class DatabaseManager:
-    
+
     def __init__(self):
-        self.connection = DatabaseConnection(config.database)
+        self.connection = AsyncDatabase(config.database)
         self.users = UserRepository(self.connection)
     
-    def get_or_create_user(self, tg_id: int, **user_data) -> Dict[str, Any]:
-        user = self.users.get_user(tg_id)
+    async def init(self) -> None:
+        await self.connection.connect()
+        await self.users.init_schema()
+    
+    async def close(self) -> None:
+        await self.connection.close()
+    
+    async def get_or_create_user(self, tg_id: int, **user_data) -> User:
+        user = await self.users.get_user(tg_id)
         if user:
             return user
         
-        return self.users.create_user(tg_id, **user_data)
+        return await self.users.create_user(tg_id, **user_data)
     
-    def ensure_sufficient_balance(self, tg_id: int, cost: int = 1) -> bool:
-        return self.users.update_balance(tg_id, -cost)
+    async def debit_balance(self, tg_id: int, cost: int = 1, **user_data) -> Optional[User]:
+        user = await self.users.debit_and_fetch(tg_id, cost)
+        if user is None and await self.users.get_user(tg_id) is None:
+            await self.users.create_user(tg_id, **user_data)
+            user = await self.users.debit_and_fetch(tg_id, cost)
+        
+        return user
 
 
 db_manager = DatabaseManager()
@@ -0,0 +1,281 @@
+import re
+import time
+import asyncio
+import logging
+from collections import deque
+from dataclasses import dataclass
+from typing import Optional, Mapping
+from contextlib import asynccontextmanager
+from config import ThrottlingConfig
+
+
+class ConcurrencyController:
+    """AIMD limiter for in-flight OpenAI requests.
+
+    The permit count grows additively on healthy responses and is cut
+    multiplicatively on rate limits or when the windowed latency exceeds
+    the target, keeping throughput just below the provider's cap. At most
+    one cut is made per decrease interval: responses already in flight
+    were issued under the old limit and must not cut it again.
+    """
+
+    def __init__(self, throttling_config: ThrottlingConfig):
+        self.min = throttling_config.min_concurrency
+        self.max = throttling_config.max_concurrency
+        self.current = float(throttling_config.initial_concurrency)
+        self.latency_target = throttling_config.latency_target
+        self.alpha = throttling_config.increase_step
+        self.beta = throttling_config.decrease_factor
+        self.decrease_interval = throttling_config.decrease_interval
+        self._latencies = deque(maxlen=throttling_config.latency_window)
+        self._last_decrease: Optional[float] = None
+        self._in_flight = 0
+        self._condition = asyncio.Condition()
+
+    @property
+    def limit(self) -> int:
+        return max(self.min, int(self.current))
+
+    @asynccontextmanager
+    async def acquire(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._in_flight < self.limit)
+            self._in_flight += 1
+
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._in_flight -= 1
+                self._condition.notify_all()
+
+    def record_latency(self, latency: float) -> None:
+        self._latencies.append(latency)
+        average = sum(self._latencies) / len(self._latencies)
+
+        if average > self.latency_target:
+            self.decrease()
+        else:
+            self.increase()
+
+    def increase(self) -> None:
+        self.current = min(self.max, self.current + self.alpha)
+
+    def decrease(self) -> None:
+        now = time.monotonic()
+        if self._last_decrease is not None and now - self._last_decrease < self.decrease_interval:
+            return
+
+        self._last_decrease = now
+        self._latencies.clear()
+        previous = self.limit
+        self.current = max(self.min, self.current * self.beta)
+        if self.limit != previous:
+            logging.warning(f"OpenAI concurrency reduced: {previous} -> {self.limit}")
+
+
+class CircuitBreaker:
+    """Stops calling a failing upstream for a cooldown period.
+
+    After the cooldown the breaker is half-open: a single probe request is
+    let through and all others are rejected until it resolves. A success
+    closes the breaker, a failure re-opens it for another cooldown.
+    """
+
+    def __init__(self, throttling_config: ThrottlingConfig):
+        self.threshold = throttling_config.breaker_threshold
+        self.cooldown = throttling_config.breaker_cooldown
+        self._failures = 0
+        self._opened_at: float = 0.0
+        self._probe: Optional[asyncio.Task] = None
+
+    @property
+    def is_open(self) -> bool:
+        return self._failures >= self.threshold
+
+    def allow_request(self) -> bool:
+        if not self.is_open:
+            return True
+
+        if time.monotonic() - self._opened_at < self.cooldown:
+            return False
+
+        if self._probe is not None and not self._probe.done():
+            return False
+
+        self._probe = asyncio.current_task()
+        logging.info("OpenAI circuit breaker half-open, sending probe request")
+        return True
+
+    def record_success(self) -> None:
+        if self.is_open:
+            logging.info("OpenAI circuit breaker closed")
+        self._failures = 0
+        self._probe = None
+
+    def record_failure(self) -> None:
+        if self.is_open:
+            if self._probe is not None and self._probe is asyncio.current_task():
+                self._probe = None
+                self._open()
+            return
+
+        self._failures += 1
+        if self.is_open:
+            self._open()
+
+    def _open(self) -> None:
+        self._opened_at = time.monotonic()
+        logging.error(f"OpenAI circuit breaker opened for {self.cooldown}s")
+
+
+_DURATION_PART = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+_DURATION_UNITS = {'ms': 0.001, 's': 1.0, 'm': 60.0, 'h': 3600.0}
+
+
+def _parse_duration(value: Optional[str]) -> Optional[float]:
+    """Parse OpenAI reset durations such as '20ms', '1s' or '6m0s'."""
+    if not value:
+        return None
+
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts)
+
+
+def _parse_int(value: Optional[str]) -> Optional[int]:
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+@dataclass
+class RateLimitState:
+    """Provider-reported quota, shared by all OpenAI calls.
+
+    Updated from the x-ratelimit-* headers of every response so callers
+    can pause before the quota runs out instead of after a 429.
+    """
+
+    min_remaining_requests: int = 2
+    min_remaining_tokens_ratio: float = 0.1
+    remaining_requests: Optional[int] = None
+    remaining_tokens: Optional[int] = None
+    limit_tokens: Optional[int] = None
+    pause_until: float = 0.0
+
+    @classmethod
+    def from_config(cls, throttling_config: ThrottlingConfig) -> 'RateLimitState':
+        return cls(
+            min_remaining_requests=throttling_config.min_remaining_requests,
+            min_remaining_tokens_ratio=throttling_config.min_remaining_tokens_ratio
+        )
+
+    @property
+    def delay(self) -> float:
+        return max(0.0, self.pause_until - time.monotonic())
+
+    async def wait(self) -> None:
+        delay = self.delay
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def pause_for(self, seconds: float) -> None:
+        self.pause_until = max(self.pause_until, time.monotonic() + seconds)
+
+    def update(self, headers: Mapping[str, str]) -> None:
+        self.remaining_requests = _parse_int(headers.get('x-ratelimit-remaining-requests'))
+        self.remaining_tokens = _parse_int(headers.get('x-ratelimit-remaining-tokens'))
+        self.limit_tokens = _parse_int(headers.get('x-ratelimit-limit-tokens'))
+
+        if (self.remaining_requests is not None
+                and self.remaining_requests <= self.min_remaining_requests):
+            reset = _parse_duration(headers.get('x-ratelimit-reset-requests'))
+            if reset:
+                self.pause_for(reset)
+                logging.warning(f"OpenAI request quota nearly exhausted, pausing {reset:.2f}s")
+
+        if (self.remaining_tokens is not None and self.limit_tokens
+                and self.remaining_tokens < self.limit_tokens * self.min_remaining_tokens_ratio):
+            reset = _parse_duration(headers.get('x-ratelimit-reset-tokens'))
+            if reset:
+                self.pause_for(reset)
+                logging.warning(f"OpenAI token quota nearly exhausted, pausing {reset:.2f}s")
+
+    def apply_retry_after(self, headers: Mapping[str, str]) -> Optional[float]:
+        retry_after = _parse_duration(headers.get('retry-after'))
+        if retry_after is not None:
+            self.pause_for(retry_after)
+        return retry_after
+
+
+class TokenBucket:
+    """Weighted token bucket refilled continuously at a fixed rate."""
+
+    def __init__(self, capacity: float, rate: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def try_acquire(self, weight: float) -> bool:
+        self._refill()
+        weight = min(weight, self.capacity)
+
+        if self.tokens < weight:
+            return False
+
+        self.tokens -= weight
+        return True
+
+    def wait_time(self, weight: float) -> float:
+        self._refill()
+        deficit = min(weight, self.capacity) - self.tokens
+        return max(0.0, deficit / self.rate)
+
+    def force_add_usage(self, weight: float) -> None:
+        """Reconcile an estimate with actual usage; may drive tokens negative."""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - weight)
+
+    @property
+    def is_full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+class UserRateLimiter:
+    """Per-user token buckets keyed by Telegram id."""
+
+    def __init__(self, throttling_config: ThrottlingConfig):
+        self.capacity = throttling_config.user_tokens_per_minute
+        self.rate = self.capacity / 60
+        self.max_buckets = throttling_config.max_tracked_users
+        self._buckets: dict[int, TokenBucket] = {}
+        self._lock = asyncio.Lock()
+
+    async def get_bucket(self, tg_id: int) -> TokenBucket:
+        async with self._lock:
+            bucket = self._buckets.get(tg_id)
+            if bucket is None:
+                if len(self._buckets) >= self.max_buckets:
+                    self._prune()
+                bucket = TokenBucket(self.capacity, self.rate)
+                self._buckets[tg_id] = bucket
+            return bucket
+
+    def _prune(self) -> None:
+        idle = [tg_id for tg_id, bucket in self._buckets.items() if bucket.is_full]
+        for tg_id in idle:
+            del self._buckets[tg_id]